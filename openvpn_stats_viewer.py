@@ -12,6 +12,10 @@ Data is stored in SQLite for historical purposes.
 If SQLite 3 or 2 is not found, no data is logged into the database, 
 which also means records are not kept.
 
+Each run also scores how far every user's send/receive rates are from 
+their usual rates, so sudden spikes (compromised or misbehaving 
+clients) stand out.  Its state is kept in osv.anomaly between runs.
+
 It is advisable to have this run via cron every minute, which is the 
 same frequency that the stats file is updated.
 
@@ -46,6 +50,12 @@ except ImportError:
 
 if sqlite:
     db = dbdriver.connect("osv.db")
+    
+    # Bumped for a stats row every time it changes, so cached query results know when they're stale
+    db.execute("create table if not exists stats_gen(sid INTEGER PRIMARY KEY, gen INTEGER, FOREIGN KEY(sid) REFERENCES stats(id))")
+    
+    # Query results kept between runs, see query_stats()
+    db.execute("create table if not exists query_cache(key TEXT PRIMARY KEY, stamp TEXT, used REAL, records TEXT)")
 else:
     db = None
     
@@ -188,10 +198,151 @@ def stats_parser():
         
     return results
 
+# Needed for the anomaly detector (state file handling and the compact state table)
+import os
+import math
+from array import array
+
+# File the anomaly detector saves its state to between runs, so we don't need to warm up from history
+ANOMALY_STATE = "osv.anomaly"
+
+# How much weight the newest rate gets in the moving average (higher reacts faster to change)
+ANOMALY_ALPHA = 0.1
+
+# How many rate samples we need for a CN before its score means anything
+ANOMALY_WARMUP = 5
+
+# Scores (standard deviations above the average rate) at or above this get flagged
+ANOMALY_THRESHOLD = 3.0
+
+# Smallest standard deviation (bytes per second) we score against, so an idle client opening a web page isn't a spike
+ANOMALY_MIN_STD = 10 * 1024.0
+
+# CNs not seen for this many seconds are dropped from the state table when it's saved
+ANOMALY_EXPIRE = 7 * 86400
+
+# Standard deviation is also at least this fraction of the average rate, so steady busy clients aren't flagged for small wobbles
+ANOMALY_REL_STD = 0.5
+
+# Layout of each CN's slot in the state table (one flat array of doubles, ANOMALY_FIELDS per CN):
+# connected since, snapshot time, bytes sent, bytes received, then average/variance of the sent
+# and received rates (bytes per second), and how many rate samples have been seen
+A_CONN, A_TIME, A_TX, A_RX, A_TX_AVG, A_TX_VAR, A_RX_AVG, A_RX_VAR, A_SAMPLES = range(9)
+ANOMALY_FIELDS = 9
+
+"""
+Loads the anomaly detector state.  Returns a dict of CN -> slot and the state table.
+"""
+def anomaly_load():
+    slots = {}
+    table = array('d')
+    
+    try:
+        with open(ANOMALY_STATE, "rb") as fp:
+            # First line is the CNs in slot order, the rest is the table itself
+            names = fp.readline().strip()
+            
+            if names:
+                names = names.split(",")
+                table.fromfile(fp, len(names) * ANOMALY_FIELDS)
+                
+                for slot, cn in enumerate(names):
+                    slots[cn] = slot
+    except (IOError, EOFError):
+        # Missing or truncated state just means we warm up again, no need to abort
+        return {}, array('d')
+    
+    return slots, table
+
+"""
+Saves the anomaly detector state, see anomaly_load() for the layout.  CNs that
+haven't been seen for ANOMALY_EXPIRE seconds (as of when) are left out.
+"""
+def anomaly_save(slots, table, when):
+    names = []
+    kept = array('d')
+    
+    for cn in sorted(slots, key=slots.get):
+        base = slots[cn] * ANOMALY_FIELDS
+        
+        # Client hasn't been around for a while, so stop carrying its slot
+        if when - table[base + A_TIME] > ANOMALY_EXPIRE:
+            continue
+        
+        names.append(cn)
+        kept.extend(table[base:base + ANOMALY_FIELDS])
+    
+    # Write to a temp file first so a crash mid-write doesn't wipe out the state
+    with open(ANOMALY_STATE + ".tmp", "wb") as fp:
+        fp.write("%s\n" % ",".join(names))
+        kept.tofile(fp)
+    
+    os.rename(ANOMALY_STATE + ".tmp", ANOMALY_STATE)
+
+# How many standard deviations the rate is from the average (standard deviation is floored, see ANOMALY_MIN_STD and ANOMALY_REL_STD)
+def zscore(rate, avg, var):
+    return (rate - avg) / max(math.sqrt(var), ANOMALY_REL_STD * abs(avg), ANOMALY_MIN_STD)
+
+"""
+Feeds a CN's snapshot to the anomaly detector and returns its score, or None if
+there isn't enough data to tell yet.
+"""
+def anomaly_update(slots, table, cn, data, when):
+    slot = slots.get(cn)
+    
+    # First time we've seen this CN, give it a slot and use this snapshot as the baseline
+    if slot == None:
+        slot = slots[cn] = len(slots)
+        table.extend([0.0] * ANOMALY_FIELDS)
+    
+    base = slot * ANOMALY_FIELDS
+    elapsed = when - table[base + A_TIME]
+    
+    # Stats file hasn't been updated since the last run, nothing new to learn
+    if elapsed == 0:
+        return None
+    
+    # New CN, reconnected, counters or the clock went backwards: start a new baseline but keep the learned rates
+    if table[base + A_TIME] == 0 or elapsed < 0 or table[base + A_CONN] != data["conn_since"] or data["bytes_tx"] < table[base + A_TX] or data["bytes_rx"] < table[base + A_RX]:
+        table[base + A_CONN] = data["conn_since"]
+        table[base + A_TIME] = when
+        table[base + A_TX] = data["bytes_tx"]
+        table[base + A_RX] = data["bytes_rx"]
+        
+        return None
+    
+    tx_rate = (data["bytes_tx"] - table[base + A_TX]) / elapsed
+    rx_rate = (data["bytes_rx"] - table[base + A_RX]) / elapsed
+    
+    score = None
+    
+    # Score against what we knew before this sample, otherwise the spike hides itself
+    if table[base + A_SAMPLES] >= ANOMALY_WARMUP:
+        score = max(
+            zscore(tx_rate, table[base + A_TX_AVG], table[base + A_TX_VAR]),
+            zscore(rx_rate, table[base + A_RX_AVG], table[base + A_RX_VAR])
+        )
+    
+    # Exponentially weighted average and variance, so we only ever need the last values
+    for rate, avg, var in ((tx_rate, A_TX_AVG, A_TX_VAR), (rx_rate, A_RX_AVG, A_RX_VAR)):
+        if table[base + A_SAMPLES] == 0:
+            table[base + avg] = rate
+        else:
+            delta = rate - table[base + avg]
+            table[base + avg] += ANOMALY_ALPHA * delta
+            table[base + var] = (1 - ANOMALY_ALPHA) * (table[base + var] + ANOMALY_ALPHA * delta * delta)
+    
+    table[base + A_SAMPLES] += 1
+    table[base + A_TIME] = when
+    table[base + A_TX] = data["bytes_tx"]
+    table[base + A_RX] = data["bytes_rx"]
+    
+    return score
+
 """
 Displays the current statistic record.
 """
-def display_record(cn, btx, brx, vip, vip_time, rip, conn):
+def display_record(cn, btx, brx, vip, vip_time, rip, conn, score=None, fmt=None):
     # Check to see if we want pretty output, default to no
     try:
         pretty = True if sys.argv[2] == "1" else False
@@ -208,18 +359,28 @@ def display_record(cn, btx, brx, vip, vip_time, rip, conn):
     # Pretty output the total session length regardless of 'pretty' option
     conn_life = ", ".join(["%d %s" % (x[0], x[1]) for x in secsfmt(diff)])
     
+    # Human-readable sent, received and total bytes, unless we were given them already (i.e.: from the query cache)
+    if fmt == None:
+        fmt = (bytesfmt(btx), bytesfmt(brx), bytesfmt(btx+brx))
+    
+    # Only shown when the anomaly detector had something to say about this record
+    anomaly = ""
+    
+    if score != None:
+        anomaly = " [anomaly score: %.2f%s]" % (score, " (ANOMALY)" if score >= ANOMALY_THRESHOLD else "")
+    
     # No pretty, display single-line text
     if pretty == False:
-        print "%s: %s bytes sent, %s received (%s total) on VPN IP %s (assigned on %s) while connecting from %s (connected since %s [total session length: %s])." % (
-            cn, bytesfmt(btx), bytesfmt(brx), bytesfmt(btx+brx), vip, vip_time, rip, conn, conn_life
+        print "%s: %s bytes sent, %s received (%s total) on VPN IP %s (assigned on %s) while connecting from %s (connected since %s [total session length: %s])%s." % (
+            cn, fmt[0], fmt[1], fmt[2], vip, vip_time, rip, conn, conn_life, anomaly
         )
     else:
         # Tree-outline of record
         print "+ %s" % cn
         print "|+ -- Data:"
-        print "|     -- In:\t\t\t%s" % bytesfmt(brx)
-        print "|     -- Out:\t\t\t%s" % bytesfmt(btx)
-        print "|     -- Total:\t\t\t%s" % bytesfmt(brx+btx)
+        print "|     -- In:\t\t\t%s" % fmt[1]
+        print "|     -- Out:\t\t\t%s" % fmt[0]
+        print "|     -- Total:\t\t\t%s" % fmt[2]
         print "|+ -- VPN:"
         print "|     -- IP:\t\t\t%s" % vip
         print "|     -- Date Given:\t\t%s" % vip_time
@@ -227,8 +388,24 @@ def display_record(cn, btx, brx, vip, vip_time, rip, conn):
         print "|     -- Real IP:\t\t%s" % rip
         print "|     -- Date Connected:\t%s" % conn
         print "|     -- Total Session Time:\t%s" % conn_life
+        
+        if score != None:
+            print "|+ -- Anomaly:"
+            print "|     -- Score:\t\t\t%.2f" % score
+            print "|     -- Flagged:\t\t%s" % ("Yes" if score >= ANOMALY_THRESHOLD else "No")
     
+# Marks a stats row as changed so any cached query results covering it are thrown out
+def bump_generation(cur, sid):
+    if cur.execute("update stats_gen set gen=gen+1 where sid=?", (sid,)).rowcount == 0:
+        cur.execute("insert into stats_gen(sid,gen) values(?,?)", (sid, 1,))
+
 def update_records(cur, report):
+    # Pick up where the anomaly detector left off last run
+    slots, table = anomaly_load()
+    
+    # The stats file is rewritten on every update, so its modification time is when this snapshot was taken
+    when = int(os.path.getmtime(openvpn_stats))
+    
     # Loop through each CN/connected account found
     for cn,data in report.iteritems():
         if db != None:
@@ -260,20 +437,144 @@ def update_records(cur, report):
             # Check for a stats ID, if it don't exist insert it otherwise update it
             #
             # The 2nd route seemed more logical?  Plus, less annoying to me.
-            sid = select(cur, "select id from stats where uid=:uid and vipid=:vip and ripid=:rip", {"uid" : uid, "vip" : vipid, "rip" : ripid})[0]
+            stat = select(cur, "select id,brx,btx from stats where uid=:uid and vipid=:vip and ripid=:rip", {"uid" : uid, "vip" : vipid, "rip" : ripid})
             
-            if sid == None:
+            if stat == None:
                 sid = cur.execute("insert into stats(uid,vipid,ripid,brx,btx) values(?,?,?,?,?)", (uid, vipid, ripid, data["bytes_rx"], data["bytes_tx"],)).lastrowid
-            else:
-                cur.execute("update stats set brx=?,btx=? where id=?", (data["bytes_rx"], data["bytes_tx"], sid,))
+                bump_generation(cur, sid)
+            elif stat[1] != data["bytes_rx"] or stat[2] != data["bytes_tx"]:
+                cur.execute("update stats set brx=?,btx=? where id=?", (data["bytes_rx"], data["bytes_tx"], stat[0],))
+                bump_generation(cur, stat[0])
             
+        # Feed this snapshot to the anomaly detector (updates its state for the CN)
+        score = anomaly_update(slots, table, cn, data, when)
+        
         # Prints out the data for each user
-        display_record(cn, data["bytes_tx"], data["bytes_rx"], data["virt_ip"], data["last_vip_str"], data["real_ip"], data["conn_since_str"])
+        display_record(cn, data["bytes_tx"], data["bytes_rx"], data["virt_ip"], data["last_vip_str"], data["real_ip"], data["conn_since_str"], score)
     
     if db != None:
+        # Make sure the stats (and their generation bumps) are saved
+        db.commit()
+        
         cur.close()
         db.close()
+    
+    # Saved after the database so not being able to write it (i.e.: read-only directory) doesn't lose the stats
+    try:
+        anomaly_save(slots, table, when)
+    except (IOError, OSError), e:
+        print "Could not save anomaly detector state to %s: %s" % (ANOMALY_STATE, e)
+        
+# Needed for the query cache (remembers the order entries were used in, and stores records in the database)
+from collections import OrderedDict
+import json
+
+# How many query results to keep (in memory, and in the query_cache table) before throwing out the least recently used
+QUERY_CACHE_SIZE = 128
+
+# (uid, since, until) -> (stamp, list of display_record() arguments), oldest used first
+query_cache = OrderedDict()
+
+# Limits a stats query to sessions connected between :since and :until (either can be None)
+RANGE_SQL = "stats.uid=:uid and (:since is null or rip.connsince >= :since) and (:until is null or rip.connsince <= :until)"
+
+"""
+Returns a stamp for the stats rows a query covers.  Any change to one of them (or a new
+one showing up in range) bumps a generation, so the stamp changes.  Rows outside the
+range don't count, so a live session doesn't throw out cached history.
+"""
+def query_stamp(cur, args):
+    stamp = select(cur, "select count(*), coalesce(sum(stats_gen.gen), 0) from stats join rip on rip.id=stats.ripid left join stats_gen on stats_gen.sid=stats.id where " + RANGE_SQL, args)
+    
+    return "%d,%d" % stamp
+
+"""
+Returns the stats records of a user as display_record() arguments, optionally only the
+sessions connected between since and until (epoch).  Results are cached in memory and in
+the database (so separate runs, i.e.: scripts, can use them) until a stats row they cover
+changes, so repeated lookups don't rerun the queries or reformat anything.
+"""
+def query_stats(cur, uid, name, since=None, until=None):
+    args = {"uid" : uid, "since" : since, "until" : until}
+    key = (uid, since, until)
+    stamp = query_stamp(cur, args)
+    
+    # Cache hit in memory, move it to the most recently used end and hand it back
+    if key in query_cache and query_cache[key][0] == stamp:
+        records = query_cache.pop(key)[1]
+        query_cache[key] = (stamp, records)
         
+        return records
+    
+    dbkey = "%s,%s,%s" % key
+    cached = select(cur, "select stamp,records from query_cache where key=:key", {"key" : dbkey})
+    
+    if cached != None and cached[0] == stamp:
+        # Cache hit from an earlier run, mark it as just used
+        records = [tuple(record) for record in json.loads(cached[1])]
+        cur.execute("update query_cache set used=? where key=?", (time.time(), dbkey,))
+    else:
+        records = []
+        
+        for stat in cur.execute("select stats.btx,stats.brx,vip.ip,vip.last_ref,rip.ip,rip.connsince from stats join vip on vip.id=stats.vipid join rip on rip.id=stats.ripid where " + RANGE_SQL + " order by stats.id", args).fetchall():
+            records.append((
+                name, 
+                stat[0], 
+                stat[1], 
+                stat[2], 
+                time.strftime("%c", time.gmtime(stat[3])), 
+                stat[4], 
+                time.strftime("%c", time.gmtime(stat[5])),
+                None,
+                (bytesfmt(stat[0]), bytesfmt(stat[1]), bytesfmt(stat[0]+stat[1]))
+            ))
+        
+        cur.execute("insert or replace into query_cache(key,stamp,used,records) values(?,?,?,?)", (dbkey, stamp, time.time(), json.dumps(records),))
+        
+        # Throw out the least recently used results if we've gone over
+        cur.execute("delete from query_cache where key not in (select key from query_cache order by used desc limit ?)", (QUERY_CACHE_SIZE,))
+    
+    db.commit()
+    
+    query_cache.pop(key, None)
+    query_cache[key] = (stamp, records)
+    
+    # Throw out the least recently used results if we've gone over
+    while len(query_cache) > QUERY_CACHE_SIZE:
+        query_cache.popitem(last=False)
+    
+    return records
+
+# Needed to turn the dates the browser shows (UTC) back into epoch
+import calendar
+
+# Same as date2epoch() but for UTC dates, so a date copied from the browser output gives back the same epoch
+def utc2epoch(date):
+    return calendar.timegm(time.strptime(date, "%c"))
+
+"""
+Asks for an optional range of connection dates to limit a lookup to, i.e.:
+Thu Oct  3 00:00:00 2013 - Fri Oct  4 00:00:00 2013
+Either side can be left blank.  Dates are UTC, same as the browser displays them.
+Returns (since, until) as epoch, None meaning no limit.
+"""
+def ask_range():
+    while True:
+        try:
+            rng = raw_input("> Enter a connection date range (<from> - <to>), blank for all: ").strip()
+        except (EOFError, KeyboardInterrupt):
+            return None, None
+        
+        if rng == "":
+            return None, None
+        
+        try:
+            since, until = [d.strip() for d in rng.split("-")]
+            
+            return utc2epoch(since) if since else None, utc2epoch(until) if until else None
+        except ValueError:
+            print "Could not understand %s, dates look like: Thu Oct  3 15:31:08 2013" % rng
+
 # Proper but in theory not required
 if __name__ == "__main__":
     cur = None
@@ -295,24 +596,30 @@ if __name__ == "__main__":
                 
                 print "[%d] %s" % (entry[0], entry[1])
             
-            uid = None
+            # Only keep asking when someone is at the keyboard.  Scripts piping a user ID in get a
+            # single lookup, served from the query_cache table if nothing it covers has changed.
+            interactive = sys.stdin.isatty()
             
-            while users.get(uid) == None:
-                uid = raw_input("> Enter the user you would like to view statistics for: ")
-            
-            for stat in cur.execute("select vipid,ripid,brx,btx from stats where uid=?", (uid,)):
-                vip = select(cur, "select ip,last_ref from vip where id=:id", {'id' : stat[0]})
-                rip = select(cur, "select ip,connsince from rip where id=:id", {'id' : stat[1]})
+            while True:
+                try:
+                    uid = raw_input("> Enter the user you would like to view statistics for%s: " % (" (q to quit)" if interactive else ""))
+                except (EOFError, KeyboardInterrupt):
+                    break
+                
+                if interactive and uid == "q":
+                    break
+                
+                if users.get(uid) == None:
+                    continue
+                
+                # Range is only asked for at the keyboard, so piping a user ID in gives the same output as always
+                since, until = ask_range() if interactive else (None, None)
+                
+                for record in query_stats(cur, uid, users[uid], since, until):
+                    display_record(*record)
                 
-                display_record(
-                    users[uid], 
-                    stat[3], 
-                    stat[2], 
-                    vip[0], 
-                    time.strftime("%c", time.gmtime(vip[1])), 
-                    rip[0], 
-                    time.strftime("%c", time.gmtime(rip[1]))
-                )
+                if not interactive:
+                    break
     else:
         report = stats_parser()
         update_records(cur, report)